@@ -2,171 +2,455 @@
 Download images from planet.com API
 """
 
+import base64
+import collections
 import configparser
 import json
 import queue
 import time
-import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import os
+import threading
 import requests
-from requests.auth import HTTPBasicAuth
+from requests.adapters import HTTPAdapter
+import urllib3
+from urllib3.util.retry import Retry
 import progressbar  # pylint: disable=E0401
+try:
+    from orjson import loads as json_loads  # pylint: disable=E0401
+except ImportError:
+    from json import loads as json_loads
 
 CONFIG = configparser.ConfigParser()
 CONFIG.read('config.ini')
 
 ITEM_TYPE = "PSScene4Band"
+ASSET_TYPES = ("analytic", "analytic_xml")
+ACTIVATE_BATCH = 32  # item ids activated concurrently
+CHECK_INTERVAL = 180  # seconds between status checks of an inactive asset
+SCAN_INTERVAL = 1000  # queued assets between rescans of download dirs
+QUEUE_SIZE = 256  # assets buffered between two stages
+# threads per stage issuing API requests
+POLL_WORKERS = CONFIG['DEFAULT'].getint('poll_workers', 16)
 
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+# flushes finished files off the download thread, one file at a time
+_CACHE_DROPPER = ThreadPoolExecutor(max_workers=1)
 
-def download_file(url, file_name):
+
+def _session():
+    """
+    Return the HTTP session shared by all stages, created on first use.
+    The pool keeps one connection per thread alive, so no thread has to
+    open a new connection after its request.
+    """
+    global _SESSION  # pylint: disable=W0603
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            _SESSION = _new_session()
+    return _SESSION
+
+
+def _new_session():
+    """
+    Session with the API key and a retrying connection pool for the
+    polling threads of activate and is_active, download and load_ids
+    """
+    session = requests.Session()
+    # encoded once instead of by an auth object on every request
+    token = base64.b64encode(
+        (CONFIG['DEFAULT']['API_KEY'] + ':').encode()).decode()
+    session.headers['Authorization'] = 'Basic ' + token
+    session.mount('https://', HTTPAdapter(
+        pool_connections=16, pool_maxsize=2 * POLL_WORKERS + 2,
+        max_retries=Retry(total=5, backoff_factor=1.0,
+                          status_forcelist=[429, 500, 502, 503, 504],
+                          allowed_methods=frozenset(['GET', 'POST']),
+                          respect_retry_after_header=True)))
+    return session
+
+
+def _advise_sequential(file_write):
+    """
+    Tell the kernel that file_write is written front to back. This is
+    advisory only, errors are ignored.
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        os.posix_fadvise(file_write.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    except OSError:
+        pass
+
+
+def _drop_cache(file_name):
+    """
+    Let the kernel evict the pages of a written file, it is not read back.
+    Only clean pages are dropped, so the data is flushed first. Runs on
+    _CACHE_DROPPER so the next download does not wait for the flush.
+    This is advisory only, errors are ignored.
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        fd = os.open(file_name, os.O_RDONLY)
+        try:
+            os.fdatasync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+
+def _preallocate(file_write, size):
+    """
+    Reserve size bytes from the current position of file_write in as
+    few extents as the filesystem allows
+    """
+    if not size:
+        return
+    if not hasattr(os, 'posix_fallocate'):
+        return
+    try:
+        os.posix_fallocate(file_write.fileno(), file_write.tell(), size)
+    except OSError:
+        pass
+
+
+def _progress_bar(size):
     """
-    Download final file
+    Progress bar for a download of size bytes, a size of None shows
+    a byte counter, as there is no end to show progress towards
+    """
+    if size is None:
+        return progressbar.ProgressBar(
+            maxval=progressbar.UnknownLength,
+            widgets=[progressbar.Counter(), ' bytes ',
+                     progressbar.FileTransferSpeed(), ' ',
+                     progressbar.AnimatedMarker()]).start()
+    return progressbar.ProgressBar(maxval=size).start()
+
+
+def _show_progress(pbar, file_write, offset, size, done):
     """
+    Update pbar with the bytes written to file_write past offset until
+    done is set, at most size bytes unless size is None
+    """
+    while not done.wait(0.5):
+        written = file_write.tell() - offset
+        if size is not None:
+            written = min(written, size)
+        pbar.update(written)
+
+
+def _copy(source, target, stop):
+    """
+    Copy source to target in 1 MiB reads. Returns False if stop was set
+    before source ended.
+    """
+    while not stop.is_set():
+        chunk = source.read(1 << 20)
+        if not chunk:
+            return True
+        target.write(chunk)
+    return False
+
+
+def download_file(url, file_name, stop):
+    """
+    Download final file. Data is written to file_name + '.part' first,
+    an existing part file from an earlier attempt is resumed. Returns
+    True if the download has to be started again, also when it was
+    interrupted by stop.
+    """
+    part_name = file_name + '.part'
+    if os.path.exists(part_name):
+        offset = os.path.getsize(part_name)
+    else:
+        offset = 0
+    headers = {'Accept-Encoding': 'identity'}
+    if offset:
+        headers['Range'] = 'bytes={}-'.format(offset)
+        print("Resuming {} at byte {}".format(file_name, offset))
     print("Downloading {} to {}".format(url, file_name))
-    with requests.get(
-        url, stream=True, timeout=10,
-        auth=HTTPBasicAuth(CONFIG['DEFAULT']['API_KEY'], '')
-    ) as result:
+    with _session().get(url, stream=True, timeout=10,
+                        headers=headers) as result:
+        if offset and result.status_code == 416:
+            # part file is as large as the whole file, but it may only be
+            # preallocated space, so start over
+            os.remove(part_name)
+            return True
+        if 'Transfer-Encoding' in result.headers:
+            print("Transfer-Encoding of {}: {}".format(
+                file_name, result.headers['Transfer-Encoding']))
         if 'Content-Length' in result.headers:
             file_size = int(result.headers['Content-Length'])
         else:
-            file_size = 1024
-        chunk_size = 1024
-        num_bars = file_size / chunk_size
-        pbar = progressbar.ProgressBar(maxval=num_bars).start()
+            file_size = None
+        pbar = _progress_bar(file_size)
         result.raise_for_status()
-        i = 0
-        with open(file_name, 'wb') as file_write:
-            for chunk in result.iter_content(chunk_size=chunk_size):
-                file_write.write(chunk)
-                pbar.update(i)
-                i += 1
+        # without 206 Partial Content the server sends the whole file
+        resume = result.status_code == 206
+        result.raw.decode_content = True
+        with open(part_name, 'r+b' if resume else 'wb') as file_write:
+            if resume:
+                file_write.seek(offset)
+            _advise_sequential(file_write)
+            _preallocate(file_write, file_size)
+            done = threading.Event()
+            progress = threading.Thread(
+                target=_show_progress,
+                args=(pbar, file_write, file_write.tell(), file_size, done))
+            progress.start()
+            try:
+                completed = _copy(result.raw, file_write, stop)
+            finally:
+                done.set()
+                progress.join()
+                # cut off preallocated space that was not written
+                file_write.truncate()
+        pbar.finish()
+    if not completed:
+        print("Download of {} stopped".format(file_name))
+        return True
+    os.rename(part_name, file_name)
+    _CACHE_DROPPER.submit(_drop_cache, file_name)
     print("Download of {} finished".format(file_name))
     return False
 
 
-def download(queue_active_assets):
+def _list_files(directory):
+    """
+    Names of the entries in directory
+    """
+    try:
+        with os.scandir(directory) as entries:
+            return {entry.name for entry in entries}
+    except FileNotFoundError:
+        return set()
+
+
+def download(queue_active_assets, active_done, stop):
     """
     Get download url and generate target file for assets from
-    active assets queue
+    active assets queue. Failed downloads are retried once no new
+    asset is queued. Ends once active_done is set, the queue is empty
+    and no retry is left.
     """
     print("### Start download process ###")
-    while True:
+    download_dirs = {section: CONFIG[section]['download']
+                     for section in CONFIG.sections()}
+    existing = {}
+    seen = 0
+    retries = collections.deque()
+    while not stop.is_set():
+        # read before the queue, no asset gets queued after it is set
+        ended = active_done.is_set()
         try:
-            item_id, section, asset_type, link = queue_active_assets.get(False)
+            asset = queue_active_assets.get(block=not retries, timeout=1.0)
         except queue.Empty:
-            time.sleep(0.1)
-            continue
-        if item_id is None:
-            if queue_active_assets.qsize == 0:
+            if retries:
+                asset = retries.popleft()
+            elif ended:
                 print("### Downloading has ended ###")
                 return
             else:
-                queue_active_assets.put((None, None, None, None))
+                continue
+        item_id, section, asset_type, link = asset
+        if seen % SCAN_INTERVAL == 0:
+            # pick up files that were added or removed by someone else
+            existing = {name: _list_files(directory)
+                        for name, directory in download_dirs.items()}
+        seen += 1
         if asset_type == "analytic":
             fname = "{}.tif".format(item_id)
         else:
             fname = "{}.xml".format(item_id)
-        print("Download queue length: {}".format(queue_active_assets.qsize()))
-        if os.path.exists(os.path.join(CONFIG[section]['download'], fname)):
+        file_name = os.path.join(download_dirs[section], fname)
+        if fname in existing[section] or os.path.exists(file_name):
+            # the stat only runs for files not listed at the last scan
+            existing[section].add(fname)
             print("File {} already exists. Skipping.".format(fname))
             continue
         try:
-            requeue = download_file(
-                link,
-                os.path.join(CONFIG[section]['download'],
-                             fname))
-        except (requests.exceptions.ReadTimeout, OSError):
+            requeue = download_file(link, file_name, stop)
+        except requests.exceptions.RetryError:
+            # the session already backed off and retried this asset
+            print("Giving up on {}".format(fname))
+            continue
+        except (requests.exceptions.ReadTimeout, OSError,
+                urllib3.exceptions.HTTPError):
             requeue = True
         if requeue:
-            queue_active_assets.put((item_id, section, asset_type, link))
+            retries.append(asset)
+        else:
+            existing[section].add(fname)
 
 
-def is_active(queue_inactive_assets, queue_active_assets):
+def _put(queue_out, item, stop):
     """
-    Check if inactive assets are activated, then queue as active
-    asset
+    Put item on queue_out, waiting for space until stop is set. Returns
+    False if the item was dropped because of stop.
     """
-    print("### Start active checking process ###")
-    while True:
+    while not stop.is_set():
         try:
-            item_id, section, asset_type, timestamp = (
-                queue_inactive_assets.get(False))
-        except queue.Empty:
-            time.sleep(0.1)
+            queue_out.put(item, timeout=1.0)
+            return True
+        except queue.Full:
             continue
-        if item_id is None:
-            if queue_inactive_assets.qsize() == 0:
+    return False
+
+
+def _drain(queue_in, max_items=None):
+    """
+    Wait up to a second for an item, then take everything queued so far,
+    at most max_items
+    """
+    try:
+        items = [queue_in.get(timeout=1.0)]
+    except queue.Empty:
+        return []
+    while max_items is None or len(items) < max_items:
+        try:
+            items.append(queue_in.get(False))
+        except queue.Empty:
+            break
+    return items
+
+
+def is_active(queue_inactive_assets, queue_active_assets,
+              inactive_done, active_done, stop):
+    """
+    Check if inactive assets are activated, then queue as active
+    asset. Assets due for a check are polled concurrently, still
+    inactive ones are kept locally until their next check.
+    """
+    print("### Start active checking process ###")
+    pending = []
+    with ThreadPoolExecutor(max_workers=POLL_WORKERS) as executor:
+        while not stop.is_set():
+            # read before the queue, no asset gets queued after it is set
+            ended = inactive_done.is_set()
+            pending.extend(_drain(queue_inactive_assets))
+            now = time.time()
+            due = {}  # item_id -> due assets, checked with one request
+            waiting = []
+            for item_id, section, asset_type, timestamp in pending:
+                if timestamp + CHECK_INTERVAL > now:
+                    waiting.append((item_id, section, asset_type, timestamp))
+                else:
+                    due.setdefault(item_id, []).append((section, asset_type))
+            pending = waiting
+            futures = {executor.submit(fetch_assets, item_id): item_id
+                       for item_id in due}
+            for future in as_completed(futures):
+                item_id = futures[future]
+                assets_result_json = future.result()
+                for section, asset_type in due[item_id]:
+                    if assets_result_json is None:
+                        # request failed, poll again later
+                        pending.append((item_id, section,
+                                        asset_type, time.time()))
+                        continue
+                    active, link = asset_state(assets_result_json,
+                                               asset_type)
+                    if active is None:
+                        print("Item {} has no asset {}. Skipping.".format(
+                            item_id, asset_type))
+                    elif active:
+                        _put(queue_active_assets,
+                             (item_id, section, asset_type, link), stop)
+                    else:
+                        pending.append((item_id, section,
+                                        asset_type, time.time()))
+            if ended and not pending:
                 print("### Activation checking has ended ###")
-                queue_active_assets.put((None, None, None, None))
+                active_done.set()
                 return
-            else:
-                queue_inactive_assets.put((None, None, None, None))
-                continue
-        if timestamp < time.time() + 180:
-            # back to queue
-            queue_inactive_assets.put((item_id, section,
-                                       asset_type, timestamp))
-        active, link = check_active_asset(item_id, asset_type)
-        if active:
-            queue_active_assets.put((item_id, section, asset_type, link))
-        queue_inactive_assets.put((item_id, section, asset_type, timestamp))
 
 
-def check_active_asset(item_id, asset_type):
+def fetch_assets(item_id):
     """
-    Check if asset is active
+    Get all assets of an item with one request, None if it failed
     """
     url = ('https://api.planet.com/data/v1/item-types/{}/items/{}/assets'
            .format(ITEM_TYPE, item_id))
     try:
-        result = requests.get(
-            url, timeout=20,
-            auth=HTTPBasicAuth(CONFIG['DEFAULT']['API_KEY'], ''))
-    except requests.exceptions.ReadTimeout:
-        print("URL {} timed out.".format(url))
-        return (None, None)
+        result = _session().get(url, timeout=20)
+    except requests.exceptions.RequestException:
+        print("Request to {} failed.".format(url))
+        return None
     try:
-        assets_result_json = result.json()
+        return json_loads(result.content)
     except json.decoder.JSONDecodeError:
+        return None
+
+
+def asset_state(assets_result_json, asset_type):
+    """
+    Check if asset is active in the assets of an item. Returns
+    (None, None) if the item has no such asset, or if there are no
+    assets because the request failed.
+    """
+    if not assets_result_json or asset_type not in assets_result_json:
         return (None, None)
-    if not assets_result_json:
-        return (None, None)
-    if assets_result_json[asset_type]['status'] == "active":
-        return (True, assets_result_json[asset_type]['location'])
-    return (False, assets_result_json[asset_type]['_links']['activate'])
+    asset = assets_result_json[asset_type]
+    if asset['status'] == "active":
+        return (True, asset['location'])
+    return (False, asset['_links']['activate'])
+
+
+def _activate_item(item_id):
+    """
+    Check all asset types of an item and request the activation of the
+    inactive ones
+    """
+    assets_result_json = fetch_assets(item_id)
+    states = []
+    for asset_type in ASSET_TYPES:
+        active, link = asset_state(assets_result_json, asset_type)
+        if active is False:
+            print("Activating {}".format(link))
+            try:
+                _session().get(link, timeout=20)
+            except requests.exceptions.RequestException:
+                print("Request to {} failed.".format(link))
+                active, link = None, None
+        states.append((asset_type, active, link))
+    return states
 
 
-def activate(queue_item_ids, queue_inactive_assets, queue_active_assets):
+def activate(queue_item_ids, queue_inactive_assets, queue_active_assets,
+             ids_done, inactive_done, stop):
     """
     If asset is inactive, activate and put on queue_inactive_assets.
     Otherweise put on queue_active_assets.
     """
     print("### Starting activation process ###")
-    while True:
-        try:
-            item_id, section = queue_item_ids.get(False)
-        except queue.Empty:
-            time.sleep(0.01)
-            continue
-        if item_id is None and section is None:
-            queue_inactive_assets.put((None, None, None, None))
-            print("### Activation has ended ###")
-            return
-        for asset_type in ["analytic", "analytic_xml"]:
-            active, link = check_active_asset(item_id, asset_type)
-            if active is None:
-                continue
-            elif active is False:
-                print("Activating {}".format(link))
-                requests.get(
-                    link,
-                    auth=HTTPBasicAuth(CONFIG['DEFAULT']['API_KEY'], ''))
-                queue_inactive_assets.put((item_id, section,
-                                           asset_type, time.time()))
-            elif active is True:
-                print("Queuing active asset: {}".format(item_id))
-                queue_active_assets.put((item_id, section, asset_type, link))
+    with ThreadPoolExecutor(max_workers=POLL_WORKERS) as executor:
+        while not stop.is_set():
+            # read before the queue, no id gets queued after it is set
+            ended = ids_done.is_set()
+            batch = _drain(queue_item_ids, ACTIVATE_BATCH)
+            if not batch and ended:
+                print("### Activation has ended ###")
+                inactive_done.set()
+                return
+            futures = {executor.submit(_activate_item, item_id):
+                       (item_id, section) for item_id, section in batch}
+            for future in as_completed(futures):
+                item_id, section = futures[future]
+                for asset_type, active, link in future.result():
+                    if active is False:
+                        _put(queue_inactive_assets,
+                             (item_id, section, asset_type, time.time()),
+                             stop)
+                    elif active is True:
+                        print("Queuing active asset: {}".format(item_id))
+                        _put(queue_active_assets,
+                             (item_id, section, asset_type, link), stop)
 
 
 def search_query(geojson_geometry, section):
@@ -212,32 +496,27 @@ def search_query(geojson_geometry, section):
     return search_request
 
 
-def search(queue_item_ids, section, search_request=None, next_link=None):
+def search(queue_item_ids, section, search_request, stop):
     """
     Get search results from API
     """
-    if next_link:
+    print("Initial search query")
+    search_result_json = json_loads(_session().post(
+        'https://api.planet.com/data/v1/quick-search',
+        json=search_request, timeout=20).content)
+    while True:
+        for feature in search_result_json['features']:
+            if not _put(queue_item_ids, (feature['id'], section), stop):
+                return
+        next_link = search_result_json['_links'].get('_next')
+        if not next_link:
+            return
         print("Next search link {}".format(next_link))
-        search_result = requests.get(
-            next_link,
-            auth=HTTPBasicAuth(CONFIG['DEFAULT']['API_KEY'], ''))
-    else:
-        print("Initial search query")
-        search_result = requests.post(
-            'https://api.planet.com/data/v1/quick-search',
-            auth=HTTPBasicAuth(CONFIG['DEFAULT']['API_KEY'], ''),
-            json=search_request)
-    search_result_json = search_result.json()
-    for feature in search_result_json['features']:
-        queue_item_ids.put((feature['id'], section))
-    if search_result_json['_links']['_next']:
-        search(queue_item_ids, section,
-               next_link=search_result_json['_links']['_next'])
-    else:
-        return
+        search_result_json = json_loads(
+            _session().get(next_link, timeout=20).content)
 
 
-def load_ids(queue_item_ids):
+def load_ids(queue_item_ids, ids_done, stop):
     """
     Wrap API search
     """
@@ -248,35 +527,60 @@ def load_ids(queue_item_ids):
         with open(CONFIG[section]['geojson']) as json_file:
             geojson_geometry = json.load(json_file)
         search_request = search_query(geojson_geometry, section)
-        search(queue_item_ids, section, search_request=search_request)
-    queue_item_ids.put((None, None))
+        search(queue_item_ids, section, search_request, stop)
+        if stop.is_set():
+            return
+    ids_done.set()
     print("### Search has ended ###")
     return
 
 
 def main():
     """
-    Spawn worker processes
-    """
-    mp.set_start_method('spawn')
-    queue_item_ids = mp.Queue()  # item_id
-    queue_inactive_assets = mp.Queue()  # (item_id, asset_type, timestamp)
-    queue_active_assets = mp.Queue()  # (item_id, asset_type)
-    p_load_ids = mp.Process(target=load_ids, args=(queue_item_ids,))
-    p_load_ids.start()
-    p_activate = mp.Process(target=activate, args=(queue_item_ids,
-                                                   queue_inactive_assets,
-                                                   queue_active_assets,))
-    p_activate.start()
-    p_is_active = mp.Process(target=is_active, args=(queue_inactive_assets,
-                                                     queue_active_assets,))
-    p_is_active.start()
-    p_download = mp.Process(target=download, args=(queue_active_assets,))
-    p_download.start()
-    p_load_ids.join()
-    p_activate.join()
-    p_is_active.join()
-    p_download.join()
+    Run the stages as threads of one process, the work is network bound
+    """
+    # (item_id, section)
+    queue_item_ids = queue.Queue(QUEUE_SIZE)
+    # (item_id, section, asset_type, timestamp)
+    queue_inactive_assets = queue.Queue(QUEUE_SIZE)
+    # (item_id, section, asset_type, link), fed by activate and is_active
+    queue_active_assets = queue.Queue(QUEUE_SIZE)
+    # set by the producer of each queue once it has queued everything
+    ids_done = threading.Event()
+    inactive_done = threading.Event()
+    # is_active ends after activate, so it alone sets this one
+    active_done = threading.Event()
+    stop = threading.Event()  # set to make the workers return early
+    t_load_ids = threading.Thread(target=load_ids,
+                                  args=(queue_item_ids, ids_done, stop,))
+    t_load_ids.start()
+    t_activate = threading.Thread(target=activate,
+                                  args=(queue_item_ids,
+                                        queue_inactive_assets,
+                                        queue_active_assets,
+                                        ids_done, inactive_done, stop,))
+    t_activate.start()
+    t_is_active = threading.Thread(target=is_active,
+                                   args=(queue_inactive_assets,
+                                         queue_active_assets,
+                                         inactive_done, active_done, stop,))
+    t_is_active.start()
+    t_download = threading.Thread(target=download,
+                                  args=(queue_active_assets,
+                                        active_done, stop,))
+    t_download.start()
+    try:
+        t_load_ids.join()
+        t_activate.join()
+        t_is_active.join()
+        t_download.join()
+    except KeyboardInterrupt:
+        print("### Stopping workers ###")
+        stop.set()
+        t_load_ids.join()
+        t_activate.join()
+        t_is_active.join()
+        t_download.join()
 
 
 if __name__ == '__main__':